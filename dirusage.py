@@ -19,108 +19,284 @@ from os import scandir
 from os.path import abspath, isdir
 import argparse
 from datetime import datetime as dt
-import re
-from termcolor import colored
+import subprocess
+from functools import lru_cache
+from math import ceil
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 
 __prog__    = "dirusage"
 __desc__    = "Show disk usage for sub-dirs of a folder"
 __version__ = "1.1"
 
+KB = 1024
+MB = 1024**2
+GB = 1024**3
+TB = 1024**4
+UNITS = ["B", "KB", "MB", "GB", "TB"]
+
+# Colour for sizes above each threshold, smallest first
+_SIZE_THRESHOLDS = [100*MB, 1*GB, 10*GB, 100*GB, 500*GB]
+_SIZE_COLORS = [None, 'blue', 'green', 'yellow', 'magenta', 'red']
+
+_SCANDIR_FD = scandir in os.supports_fd
+
+# ANSI SGR escape codes, as used by termcolor
+_COLORS = {'grey': '\x1b[30m', 'red': '\x1b[31m', 'green': '\x1b[32m',
+           'yellow': '\x1b[33m', 'blue': '\x1b[34m', 'magenta': '\x1b[35m',
+           'cyan': '\x1b[36m', 'white': '\x1b[37m', None: ''}
+_HIGHLIGHTS = {'on_grey': '\x1b[40m', 'on_red': '\x1b[41m', 'on_green': '\x1b[42m',
+               'on_yellow': '\x1b[43m', 'on_blue': '\x1b[44m', 'on_magenta': '\x1b[45m',
+               'on_cyan': '\x1b[46m', 'on_white': '\x1b[47m', None: ''}
+_ATTRIBUTES = {'bold': '\x1b[1m', 'dark': '\x1b[2m', 'underline': '\x1b[4m',
+               'blink': '\x1b[5m', 'reverse': '\x1b[7m', 'concealed': '\x1b[8m'}
+_RESET = '\x1b[0m'
+
 
 def tree(dir,
          max_depth=1,
-         min_size=0,
-         padding='',
-         isLast=False,
-         isFirst=True,
-         start_depth=None):
-    depth = dir.count(os.sep)
-    if start_depth is None:
-        start_depth = depth
-    if isFirst:
-        max_depth = depth + max_depth
-    if (max_depth is not None and depth >= max_depth):
-        return
+         min_bytes=0,
+         sizes=None,
+         children=None):
+    if sizes is None or children is None:
+        sizes = {}
+        children = {}
+        walk_sizes(dir, max_depth, sizes, children)
 
     pre_padding = '           '
-    if depth > (start_depth + 1):
-        padding = padding + '                  '
-
-    dirs = [x for x in scandir(dir) if x.is_dir()]
-    dirs = sorted((d for d in dirs if dir_size(d.path) >= (min_size * 1024**2)),
-                    key=lambda s: dir_size(s.path),
-                    reverse=True)
-    count = 0
-    last = len(dirs) - 1
-    for i, f in enumerate(dirs):
-        count += 1
-        path = dir + os.sep + f.name
-        isLast = i == last
-        if isFirst:
-            print(' ' + human(dir_size(f.path)) + '  ' + prettify(f.name, "white", attrs=['bold']))
+    # Branch glyph and the indent it leaves for the level below,
+    # indexed by whether the entry is the last of its siblings
+    branches = ('├── ', '└── ')
+    indents = ('│                 ', '                  ')
+
+    # Explicit DFS stack of (path, name, size, depth, padding, isLast)
+    # entries, so deep trees don't hit the recursion limit. Each entry is
+    # printed when popped, then its own sub-dirs are pushed in reverse
+    # so they come off the stack largest first, before its siblings.
+    # Lines are collected and written out in one go at the end.
+    lines = []
+    stack = []
+    if max_depth > 0:
+        stack.extend(reversed(subdir_frames(dir, 1, '', min_bytes, sizes, children)))
+    while stack:
+        path, name, size, depth, padding, isLast = stack.pop()
+        human_size = human(size)
+        if depth == 1:
+            lines.append(f' {human_size}  {prettify(name, "white", attrs=["bold"])}')
         else:
-            if isLast:
-                print(pre_padding + padding[:-1] + '└── ' + '[ ' + human(dir_size(f.path)) + ' ]  ' + f.name)
-            else:
-                print(pre_padding + padding[:-1] + '├── ' + '[ ' + human(dir_size(f.path)) + ' ]  ' + f.name)
-        if isdir(path):
-            if count == len(dirs):
-                tree(path, max_depth, min_size, padding[:-1] + ' ', isLast, False, start_depth)
-            else:
-                if isFirst:
-                    tree(path, max_depth, min_size, padding, isLast, False, start_depth)
-                else:
-                    tree(path, max_depth, min_size, padding[:-1] + '│', isLast, False, start_depth)
+            lines.append(f'{pre_padding}{padding}{branches[isLast]}[ {human_size} ]  {name}')
+        if depth < max_depth:
+            # Siblings share their parent's padding string; only the
+            # parent's own indent is appended, once per parent
+            child_padding = '' if depth == 1 else padding + indents[isLast]
+            stack.extend(reversed(subdir_frames(path, depth + 1, child_padding, min_bytes, sizes, children)))
+    if lines:
+        print('\n'.join(lines))
     return 0
 
 
-def dir_size(path):
+def subdir_frames(dir, depth, padding, min_bytes, sizes, children):
+    # Sub-dirs and their sizes both come from the same single walk (or
+    # du report), so dir is not listed again and no entry is ever sized
+    # by other means. Symlinked dirs aren't among them, as the walk
+    # doesn't follow them and they don't count towards the total. The
+    # size lookup and min_bytes filter are done in one pass.
+    pairs = []
+    for path in children.get(dir, ()):
+        size = sizes[path]
+        if size >= min_bytes:
+            pairs.append((path, size))
+    pairs.sort(key=lambda p: p[1], reverse=True)
+    last = len(pairs) - 1
+    return [(path, os.path.basename(path), size, depth, padding, i == last)
+            for i, (path, size) in enumerate(pairs)]
+
+
+def walk_sizes(path, max_depth=None, out=None, children=None, scan=None):
+    # Single walk: returns the total size of path and records the size of
+    # every sub-dir down to max_depth levels in out, keyed by DirEntry.path,
+    # and the sub-dirs of every dir above that depth in children. Dirs are visited post-order with an explicit
+    # stack of [path, depth, total, sub-dirs still to visit] frames; a
+    # frame is added into its parent and dropped as soon as its own
+    # sub-dirs are done, so only the current branch is held in memory.
+    # Sub-dirs are held in reverse so they're popped in listing order,
+    # which decides the dir a hard-linked file is counted towards.
+    # scan stands in for scan_dir(), e.g. to read listings ahead.
+    if scan is None:
+        scan = scan_dir
+    seen = set()
+    stack = [[path, 0, 0, None]]
+    while True:
+        frame = stack[-1]
+        if frame[3] is None:
+            files_size, subdirs, links = scan(frame[0])
+            frame[2] += files_size + count_links(links, seen)
+            frame[3] = subdirs[::-1]
+            if children is not None and (max_depth is None or frame[1] < max_depth):
+                children[frame[0]] = subdirs
+        if frame[3]:
+            stack.append([frame[3].pop(), frame[1] + 1, 0, None])
+            continue
+        stack.pop()
+        p, depth, total = frame[:3]
+        if not stack:
+            return total
+        stack[-1][2] += total
+        if out is not None and (max_depth is None or depth <= max_depth):
+            out[p] = total
+
+
+def walk_sizes_parallel(path, max_depth=None, out=None, children=None, jobs=None):
+    # Same result as walk_sizes(), which still does the walk, but the
+    # dirs it will visit next are listed ahead of it in a thread pool;
+    # scandir and stat release the GIL, so the listings overlap. Dirs are
+    # handed out in batches of 4 to cut the per-task overhead, with at
+    # most one batch per thread in flight, and the walk consumes them in
+    # the same order as a sequential one, so hard links are credited to
+    # the same dirs whatever the number of threads.
+    if jobs is None:
+        # With a single CPU the workers only add overhead on a warm cache
+        cpus = os.cpu_count() or 1
+        jobs = cpus * 4 if cpus > 1 else 1
+    if jobs <= 1:
+        return walk_sizes(path, max_depth, out, children)
+    limit = jobs * 4
+    batch = 4
+    pending = {}
+    # Dirs known but not yet listed, the next one the walk visits on top
+    ahead = []
+
+    def scan_batch(paths):
+        return [scan_dir(p) for p in paths]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        def scan(p):
+            queued = pending.pop(p, None)
+            if queued is None:
+                if ahead and ahead[-1] == p:
+                    ahead.pop()
+                listing = scan_dir(p)
+            else:
+                future, i = queued
+                listing = future.result()[i]
+            ahead.extend(reversed(listing[1]))
+            while ahead and len(pending) < limit:
+                paths = ahead[-batch:][::-1]
+                del ahead[-batch:]
+                future = pool.submit(scan_batch, paths)
+                for i, q in enumerate(paths):
+                    pending[q] = (future, i)
+            return listing
+
+        return walk_sizes(path, max_depth, out, children, scan)
+
+
+def scan_dir(path):
+    # One listing of path: the total size of the files directly in it,
+    # the paths of its sub-dirs (symlinks are not followed), and the
+    # ((st_dev, st_ino), size) of hard-linked files, which are left out
+    # of the total so the caller can count each of them once. Where the
+    # platform allows, the dir is listed through an open fd so each
+    # file is stat()ed relative to it, rather than by resolving its full
+    # path from the root again.
+    size = 0
+    subdirs = []
+    links = []
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY) if _SCANDIR_FD else None
+    try:
+        with scandir(path if fd is None else fd) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(os.path.join(path, entry.name))
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_nlink > 1:
+                        links.append(((st.st_dev, st.st_ino), st.st_size))
+                    else:
+                        size += st.st_size
+    finally:
+        if fd is not None:
+            os.close(fd)
+    return size, subdirs, links
+
+
+def count_links(links, seen):
+    # Like du, a hard-linked file only counts towards the first dir it's
+    # found in; seen collects the (st_dev, st_ino) of those counted so far.
     size = 0
-    for entry in scandir(path):
-        if entry.is_dir(follow_symlinks=False):
-            size += dir_size(entry.path)
-        elif entry.is_file(follow_symlinks=False):
-            size += entry.stat().st_size
+    for key, link_size in links:
+        if key not in seen:
+            seen.add(key)
+            size += link_size
     return size
 
 
-def human(size, colorize=True, whole_numbers=False):
-    B  = "B"
-    KB = "KB"
-    MB = "MB"
-    GB = "GB"
-    TB = "TB"
-    UNITS = [B, KB, MB, GB, TB]
-    HUMANRADIX = 1024.
+def du_sizes(path, max_depth=None, out=None, children=None):
+    # Let du(1) walk the tree in a single C process and parse its report
+    # into the same maps walk_sizes() builds; each reported dir is also
+    # listed as a sub-dir of its parent. Returns the total size of
+    # path, or None if du isn't available or couldn't read the whole tree
+    # (its partial report would undercount). A symlinked root is followed,
+    # as the built-in walk does.
+    cmd = ['du', '--bytes', '--null', '--dereference-args']
+    if max_depth is not None:
+        cmd += ['--max-depth', str(max(max_depth, 0))]
+    cmd += ['--', path]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    total = None
+    for record in result.stdout.split(b'\0'):
+        size, _, p = record.partition(b'\t')
+        if not p:
+            continue
+        rel = os.path.relpath(os.fsdecode(p), path)
+        if rel == os.curdir:
+            total = int(size)
+            continue
+        key = os.path.join(path, rel)
+        if out is not None:
+            out[key] = int(size)
+        if children is not None:
+            parent = os.path.dirname(rel)
+            children.setdefault(os.path.join(path, parent) if parent else path, []).append(key)
+    # Every dir tree() will show must have been sized by du itself; if
+    # the report skipped one, don't use it at all rather than mixing in
+    # sizes measured another way.
+    if children is not None and out is not None:
+        if any(parent != path and parent not in out for parent in children):
+            return None
+    return total
+
+
+def human(size, colorize=True, whole_numbers=False, strip=False):
+    human_string, color, bg = _human_core(int(round(size)), whole_numbers, strip)
+    if colorize:
+        return prettify(human_string, color, bg)
+    else:
+        return human_string
+
+
+@lru_cache(maxsize=4096)
+def _human_core(size, whole_numbers, strip):
+    # The uncoloured conversion behind human(); sizes repeat a lot (empty
+    # dirs, dirs holding a single file), so results are cached per size.
+    HUMANRADIX = float(KB)
 
-    if whole_numbers:
+    if strip:
+        # Unpadded, for use inline in a sentence rather than in a column
+        format_string = '{:.0f} {:s}' if whole_numbers else '{:.1f} {:s}'
+    elif whole_numbers:
         format_string = '{: >3.0f} {: >2s}'
     else:
         format_string = '{: >5.1f} {: >2s}'
 
-    if size > 500*(1024**3):
-        # > 500 GB
-        color = 'red'
-        bg = None
-    elif size > 100*(1024**3):
-        # > 100 GB
-        color = 'magenta'
-        bg = None
-    elif size > 10*(1024**3):
-        # > 10 GB
-        color = 'yellow'
-        bg = None
-    elif size > 1*(1024**3):
-        # > 1 GB
-        color = 'green'
-        bg = None
-    elif size > 100*(1024**2):
-        # > 100 MB
-        color = 'blue'
-        bg = None
-    else:
-        color = None
-        bg = None
+    # Sizes above each threshold get the next colour up
+    color = _SIZE_COLORS[bisect_left(_SIZE_THRESHOLDS, size)]
+    bg = None
 
     human_string = None
     for u in UNITS[:-1]:
@@ -132,19 +308,26 @@ def human(size, colorize=True, whole_numbers=False):
     if human_string is None:
         human_string = format_string.format(size, UNITS[-1])
 
-    if colorize:
-        return prettify(human_string, color, bg)
-    else:
-        return human_string
+    return human_string, color, bg
 
 
 def prettify(msg, color=None, bg=None, attrs=[]):
-    if pretty:
-        return colored(msg, color, bg, attrs)
+    if not pretty:
+        return msg
+    prefix = _COLORS[color] + _HIGHLIGHTS[bg] + ''.join(_ATTRIBUTES[a] for a in attrs)
+    if prefix:
+        return f'{prefix}{msg}{_RESET}'
     else:
         return msg
 
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not " + value)
+    return number
+
+
 def main():
     try:
         parser = argparse.ArgumentParser(prog=__prog__)
@@ -156,6 +339,12 @@ def main():
         parser.add_argument(
             "-s", "--min-size", action="store", default=0, type=float,
             help="minimum folder size (MB) to draw branches for")
+        parser.add_argument(
+            "-j", "--jobs", action="store", default=None, type=positive_int,
+            help="number of threads to scan dirs with (default is 4x the number of CPUs, or 1 on a single CPU)")
+        parser.add_argument(
+            "--du", action="store_true", default=False,
+            help="measure sizes with du(1), faster on very large trees (also counts the dirs themselves)")
         parser.add_argument(
             "-c", "--colorize", action="store_true", default=False,
             help="colorize the output")
@@ -170,10 +359,11 @@ def main():
 
         global pretty
         pretty = args.colorize
+        min_bytes = ceil(args.min_size * MB)
 
         print("Current usage for " + prettify(abspath(args.path), "white", attrs=['bold']) + " at " + dt.now().strftime("%a %b %d %Y %H:%M"))
         print(prettify("(Showing folders bigger than " +
-                      re.sub('^\s*([0-9.]+ [KMGT]?B)\s*$', '\g<1>', human(args.min_size * (1024**2), colorize=False, whole_numbers=True)) +
+                      human(min_bytes, colorize=False, whole_numbers=True, strip=True) +
                       " up to " +
                       str(args.max_depth) +
                       (" level " if (args.max_depth == 1) else " levels ") +
@@ -182,12 +372,21 @@ def main():
              )
         )
         print()
-        tree(dir=args.path, max_depth=args.max_depth, min_size=args.min_size)
+        sizes = {}
+        children = {}
+        total = None
+        if args.du:
+            total = du_sizes(args.path, args.max_depth, sizes, children)
+        if total is None:
+            sizes = {}
+            children = {}
+            total = walk_sizes_parallel(args.path, args.max_depth, sizes, children, args.jobs)
+        tree(dir=args.path, max_depth=args.max_depth, min_bytes=min_bytes, sizes=sizes, children=children)
 
         s = os.statvfs(args.path)
         print()
         print(' --------  ----------------')
-        print(' ' + human(dir_size(args.path), False) + '  ' + 'total usage')
+        print(' ' + human(total, False) + '  ' + 'total usage')
         print(' ' + human(s.f_bavail * s.f_frsize, False) + '  ' + 'free space remaining')
 
         return 0